@@ -1,11 +1,25 @@
-from importlib import metadata
+import importlib
 
-from . import bloomfilter, field_formats, key_derivation, schema, randomnames, describe
+from . import bloomfilter, field_formats, key_derivation, schema
 from .schema import Schema
 
-try:
-    __version__ = metadata.version('clkhash')
-except metadata.PackageNotFoundError:
-    __version__ = "development"
+# These are not needed to hash data, so they are only imported on first
+# access, e.g. ``clkhash.randomnames``.
+_LAZY_SUBMODULES = frozenset({'randomnames', 'describe'})
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if name == '__version__':
+        from importlib import metadata
+        try:
+            version = metadata.version('clkhash')
+        except metadata.PackageNotFoundError:
+            version = "development"
+        globals()['__version__'] = version
+        return version
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __author__ = "Data61"
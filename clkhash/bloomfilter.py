@@ -4,29 +4,27 @@
 Generate a Bloom filter
 """
 
-import hmac
+import hashlib
 import math
 import struct
-from functools import lru_cache
-from hashlib import md5, sha1
-from typing import Callable, Iterable, List, Sequence, Tuple
+from functools import lru_cache, partial
+from hashlib import blake2b
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, cast
 from bitarray import bitarray
 
-from clkhash.field_formats import FieldHashingProperties
+from clkhash.field_formats import FieldHashingProperties, FieldSpec
 from clkhash.schema import Schema
 from clkhash.comparators import AbstractComparison, NonComparison
 
-try:
-    from hashlib import blake2b
-except ImportError:
-    # We are in Python older than 3.6.
-    from pyblake2 import blake2b  # type: ignore
-    # Ignore because otherwise Mypy raises errors, thinking that
-    # blake2b is already defined.
 
-
-TOKEN_CACHE_SIZE = 2 ** 15
+# The per-token caches hold bit templates as long as the Bloom filter
+# rather than a pair of indices, so fewer of them are kept.
+TOKEN_CACHE_SIZE = 2 ** 12
 NGRAM_CACHE_SIZE = 2 ** 17
+FIELD_CACHE_SIZE = 2 ** 12
+KEY_CACHE_SIZE = 2 ** 10
+
+_unpack_u64 = struct.Struct('>Q').unpack_from
 
 
 def double_hash_encode_ngrams(ngrams: Iterable[str],
@@ -107,48 +105,120 @@ def _double_hash_encode_ngrams(ngrams: Tuple[str, ...],
                                encoding: str,
                                non_singular: bool
                               ) -> bitarray:
-    key_sha1, key_md5 = keys
+    # The HMAC key setup is done once here rather than for every token.
+    sha1_contexts = _hmac_contexts(keys[0], 'sha1')
+    md5_contexts = _hmac_contexts(keys[1], 'md5')
     bf = bitarray(l)
     bf.setall(False)
 
     for m, k in zip(ngrams, ks):
-        m_bytes = m.encode(encoding=encoding)
-        if non_singular:
-            md5hm, sha1hm = _double_hash_token_non_singular(m_bytes, l, key_sha1, key_md5)
-        else:
-            md5hm, sha1hm = _double_hash_token(m_bytes, l, key_sha1, key_md5)
-        for i in range(k):
-            gi = (sha1hm + i * md5hm) % l
-            bf[gi] = 1
+        bf |= _double_hash_token_bits(m, encoding, k, l,
+                                      sha1_contexts, md5_contexts, non_singular)
     return bf
 
 
 @lru_cache(maxsize=TOKEN_CACHE_SIZE)
-def _double_hash_token(m: bytes, l: int, key_sha1: bytes, key_md5: bytes):
-    sha1hm = int(
-        hmac.new(key_sha1, m, sha1).hexdigest(),
-        16) % l
-    md5hm = int(
-        hmac.new(key_md5, m, md5).hexdigest(),
-        16) % l
+def _double_hash_token_bits(m: str,
+                            encoding: str,
+                            k: int,
+                            l: int,
+                            sha1_contexts: Tuple[Any, Any],
+                            md5_contexts: Tuple[Any, Any],
+                            non_singular: bool
+                            ) -> bitarray:
+    """ The bits of a single token, to be ORed into the Bloom filter.
+
+        Caching these per token turns the k single bit assignments of a
+        repeated token into one bitwise OR. The cache is keyed on the
+        token string, so it is only encoded to bytes on a cache miss.
+    """
+    m_bytes = m.encode(encoding=encoding)
+    if non_singular:
+        md5hm, sha1hm = _double_hash_token_non_singular(m_bytes, l, sha1_contexts, md5_contexts)
+    else:
+        md5hm, sha1hm = _double_hash_token(m_bytes, l, sha1_contexts, md5_contexts)
+    bits = bitarray(l)
+    bits.setall(False)
+    if md5hm == 0:
+        # All k indices coincide, and range() rejects a zero step.
+        if k > 0:
+            bits[sha1hm] = 1
+        return bits
+    # Step through sha1hm + i * md5hm by addition instead of multiplying.
+    # If l is a power of two, reducing modulo l is a bitwise and.
+    if l & (l - 1) == 0:
+        mask = l - 1
+        for g in range(sha1hm, sha1hm + k * md5hm, md5hm):
+            bits[g & mask] = 1
+    else:
+        for g in range(sha1hm, sha1hm + k * md5hm, md5hm):
+            bits[g % l] = 1
+    return bits
+
+
+def _double_hash_token(m: bytes, l: int,
+                       sha1_contexts: Tuple[Any, Any],
+                       md5_contexts: Tuple[Any, Any]):
+    sha1hm = _digest_mod(_hmac_digest(sha1_contexts, m), l)
+    md5hm = _digest_mod(_hmac_digest(md5_contexts, m), l)
     return md5hm, sha1hm
 
 
-@lru_cache(maxsize=TOKEN_CACHE_SIZE)
-def _double_hash_token_non_singular(m_bytes: bytes, l: int, key_sha1: bytes, key_md5: bytes):
-    sha1hm_bytes = hmac.new(key_sha1, m_bytes, sha1).digest()
-    md5hm_bytes = hmac.new(key_md5, m_bytes, md5).digest()
-    sha1hm = int.from_bytes(sha1hm_bytes, 'big') % l
-    md5hm = int.from_bytes(md5hm_bytes, 'big') % l
+def _double_hash_token_non_singular(m_bytes: bytes, l: int,
+                                    sha1_contexts: Tuple[Any, Any],
+                                    md5_contexts: Tuple[Any, Any]):
+    sha1hm = _digest_mod(_hmac_digest(sha1_contexts, m_bytes), l)
+    md5hm = _digest_mod(_hmac_digest(md5_contexts, m_bytes), l)
     i = 0
     while md5hm == 0:
-        md5hm_bytes = hmac.new(
-            key_md5, m_bytes + chr(i).encode(), md5).digest()
-        md5hm = int.from_bytes(md5hm_bytes, 'big') % l
+        md5hm_bytes = _hmac_digest(md5_contexts, m_bytes + chr(i).encode())
+        md5hm = _digest_mod(md5hm_bytes, l)
         i += 1
     return md5hm, sha1hm
 
 
+def _digest_mod(digest: bytes, l: int) -> int:
+    """ Same as ``int.from_bytes(digest, 'big') % l``.
+
+        If l is a power of two only the trailing eight bytes of the digest
+        matter, so they are read as a native integer instead of building a
+        big integer from the whole digest.
+    """
+    if l & (l - 1) == 0 and l <= 2 ** 64:
+        return _unpack_u64(digest, len(digest) - 8)[0] & (l - 1)
+    return int.from_bytes(digest, 'big') % l
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _hmac_contexts(key: bytes, digestmod: str) -> Tuple[Any, Any]:
+    """ Inner and outer hash contexts of an HMAC with the padded key
+        blocks already compressed.
+
+        Each token then only costs copying the contexts and hashing the
+        token and the inner digest, instead of setting up the key for
+        every ``hmac.new`` call.
+    """
+    inner = hashlib.new(digestmod)
+    outer = hashlib.new(digestmod)
+    if len(key) > inner.block_size:
+        key = hashlib.new(digestmod, key).digest()
+    key = key.ljust(inner.block_size, b'\0')
+    inner.update(bytes(x ^ 0x36 for x in key))
+    outer.update(bytes(x ^ 0x5C for x in key))
+    return inner, outer
+
+
+def _hmac_digest(contexts: Tuple[Any, Any], m: bytes) -> bytes:
+    """ Same as ``hmac.digest(key, m, digestmod)`` for the contexts
+        returned by :func:`_hmac_contexts`.
+    """
+    inner = contexts[0].copy()
+    inner.update(m)
+    outer = contexts[1].copy()
+    outer.update(inner.digest())
+    return outer.digest()
+
+
 def blake_encode_ngrams(ngrams: Iterable[str],
                         keys: Sequence[bytes],
                         ks: Sequence[int],
@@ -239,22 +309,40 @@ def _blake_encode_ngrams(ngrams: Tuple[str, ...],
     bf.setall(False)
 
     for m, k in zip(ngrams, ks):
-        for idx in blake_hash_token(m.encode(encoding=encoding), k, key, l):
-            bf[idx] = 1
+        bf |= _blake_token_bits(m, encoding, k, key, l)
     return bf
 
 
 @lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _blake_token_bits(m: str, encoding: str, k: int, key: bytes, l: int) -> bitarray:
+    """ The bits of a single token, to be ORed into the Bloom filter. """
+    bits = bitarray(l)
+    bits.setall(False)
+    for idx in blake_hash_token(m.encode(encoding=encoding), k, key, l):
+        bits[idx] = 1
+    return bits
+
+
 def blake_hash_token(token: bytes, k: int, key: bytes, l: int):
-    random_shorts = []  # type: List[int]
     num_macs = (k + 31) // 32
-    for i in range(num_macs):
-        hash_bytes = blake2b(token, key=key,
-                             salt=str(i).encode()).digest()
-        random_shorts.extend(struct.unpack('32H',
-                                           hash_bytes))  # interpret
-        # hash bytes as 32 unsigned shorts.
-    return [random_shorts[i] % l for i in range(k)]
+    macs = [_keyed_blake2b(key, i).copy() for i in range(num_macs)]
+    for mac in macs:
+        mac.update(token)
+    hash_bytes = b''.join(mac.digest() for mac in macs)
+    # interpret hash bytes as unsigned shorts, 32 per MAC.
+    random_shorts = memoryview(hash_bytes).cast('H')[:k]
+    return [short % l for short in random_shorts]
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _keyed_blake2b(key: bytes, i: int):
+    """ BLAKE2b context with the key block already compressed.
+
+        Copying it and feeding in a token gives the same digest as
+        ``blake2b(token, key=key, salt=str(i).encode())``, without
+        processing the key again for every token.
+    """
+    return blake2b(key=key, salt=str(i).encode())
 
 
 def hashing_function_from_properties(
@@ -298,14 +386,66 @@ def fold_xor(bloomfilter: bitarray,
         raise ValueError(msg)
 
     for _ in range(folds):
-        bf1 = bloomfilter[:len(bloomfilter) // 2]
-        bf2 = bloomfilter[len(bloomfilter) // 2:]
+        half = len(bloomfilter) // 2
+        folded = bloomfilter[:half]
+        folded ^= bloomfilter[half:]
 
-        bloomfilter = bf1 ^ bf2
+        bloomfilter = folded
 
     return bloomfilter
 
 
+FieldEncoder = Callable[[str], Optional[bitarray]]
+
+
+def _encode_field(entry: str,
+                  field: FieldSpec,
+                  comparator: AbstractComparison,
+                  key: Sequence[bytes],
+                  l: int
+                  ) -> Optional[bitarray]:
+    """ Encodes a single value of a field into a Bloom filter of length l.
+
+        Returns None if the value produces no tokens. The returned filter
+        may be shared with the caches of the hash functions, so it must
+        not be modified.
+    """
+    fhp = cast(FieldHashingProperties, field.hashing_properties)
+    # A tuple, so the hash functions can use it as a cache key as is.
+    ngrams = tuple(comparator.tokenize(field.format_value(entry)))
+    if not ngrams:
+        return None
+    hash_function = hashing_function_from_properties(fhp)
+    return hash_function(ngrams, key,
+                         fhp.strategy.bits_per_token(len(ngrams)),
+                         l, fhp.encoding)
+
+
+def _field_encoder(field: FieldSpec,
+                   comparator: AbstractComparison,
+                   key: Sequence[bytes],
+                   l: int
+                   ) -> FieldEncoder:
+    """ Creates the function encoding the values of a single field.
+
+        Values of low cardinality fields (e.g. gender) repeat across
+        records, so the encodings are cached to skip formatting,
+        tokenizing and hashing them again.
+    """
+    encode = partial(_encode_field, field=field, comparator=comparator, key=key, l=l)
+    return lru_cache(maxsize=FIELD_CACHE_SIZE)(encode)
+
+
+def _field_encoders(comparators: Sequence[AbstractComparison],
+                    schema: Schema,
+                    keys: Sequence[Sequence[bytes]]
+                    ) -> List[Optional[FieldEncoder]]:
+    hash_l = schema.l * 2 ** schema.xor_folds
+    return [_field_encoder(field, comparator, key, hash_l)
+            if field.hashing_properties else None
+            for field, comparator, key in zip(schema.fields, comparators, keys)]
+
+
 def crypto_bloom_filter(record: Sequence[str],
                         comparators: List[AbstractComparison],
                         schema: Schema,
@@ -329,25 +469,49 @@ def crypto_bloom_filter(record: Sequence[str],
     """
     hash_l = schema.l * 2 ** schema.xor_folds
 
-    bloomfilter = bitarray(hash_l)
-    bloomfilter.setall(False)
-
+    bloomfilter = _empty_bloom_filter(schema)
     for (entry, comparator, field, key) \
             in zip(record, comparators, schema.fields, keys):
-        fhp = field.hashing_properties
-        if fhp:
-            ngrams = list(comparator.tokenize(field.format_value(entry)))
-            hash_function = hashing_function_from_properties(fhp)
-
-            if ngrams:
-                bloomfilter |= hash_function(ngrams, key,
-                                             fhp.strategy.bits_per_token(len(ngrams)),
-                                             hash_l, fhp.encoding)
+        if field.hashing_properties:
+            field_bloomfilter = _encode_field(entry, field, comparator, key, hash_l)
+            if field_bloomfilter is not None:
+                bloomfilter |= field_bloomfilter
 
     bloomfilter = fold_xor(bloomfilter, schema.xor_folds)
     return bloomfilter, record[0], bloomfilter.count()
 
 
+def _empty_bloom_filter(schema: Schema) -> bitarray:
+    bloomfilter = bitarray(schema.l * 2 ** schema.xor_folds)
+    bloomfilter.setall(False)
+    return bloomfilter
+
+
+def _crypto_bloom_filter(record: Sequence[str],
+                         field_encoders: Sequence[Optional[FieldEncoder]],
+                         empty_bloomfilter: bitarray,
+                         xor_folds: int
+                         ) -> Tuple[bitarray, str, int]:
+    # The field filters are cached and shared, so the record filter
+    # starts as a copy of the first one and the others are ORed into it.
+    bloomfilter = None  # type: Optional[bitarray]
+    for entry, encode in zip(record, field_encoders):
+        if encode is not None:
+            field_bloomfilter = encode(entry)
+            if field_bloomfilter is None:
+                continue
+            if bloomfilter is None:
+                bloomfilter = field_bloomfilter.copy()
+            else:
+                bloomfilter |= field_bloomfilter
+    if bloomfilter is None:
+        # Copying a zeroed filter is cheaper than allocating and clearing one.
+        bloomfilter = empty_bloomfilter.copy()
+
+    bloomfilter = fold_xor(bloomfilter, xor_folds)
+    return bloomfilter, record[0], bloomfilter.count()
+
+
 def stream_bloom_filters(dataset: Iterable[Sequence[str]],
                          keys: Sequence[Sequence[bytes]],
                          schema: Schema
@@ -358,9 +522,15 @@ def stream_bloom_filters(dataset: Iterable[Sequence[str]],
         :param dataset: An iterable of indexable records.
         :param schema: An instantiated Schema instance
         :param keys: A tuple of two lists of secret keys used in the HMAC.
-        :return: Generator yielding bloom filters as 3-tuples
+        :return: Iterator yielding bloom filters as 3-tuples
     """
     comparators = [field.hashing_properties.comparator if field.hashing_properties is not None else NonComparison()
                   for field in schema.fields]
-    return (crypto_bloom_filter(s, comparators, schema, keys)
-            for s in dataset)
+    # The field encoders cache the encodings of repeated values for the
+    # lifetime of this stream.
+    field_encoders = _field_encoders(comparators, schema, keys)
+    return map(partial(_crypto_bloom_filter,
+                       field_encoders=field_encoders,
+                       empty_bloomfilter=_empty_bloom_filter(schema),
+                       xor_folds=schema.xor_folds),
+               dataset)
@@ -6,11 +6,14 @@ import concurrent.futures
 import csv
 import logging
 import multiprocessing
+import os
 from multiprocessing import Process, Queue
 from itertools import islice
-from threading import Thread
+from queue import Empty, Full
+from threading import BoundedSemaphore, Thread
 from typing import (
     AnyStr,
+    IO,
     Callable,
     cast,
     Iterable,
@@ -22,6 +25,7 @@ from typing import (
     Union,
     Iterator,
     TextIO,
+    TYPE_CHECKING,
 )
 from bitarray import bitarray
 from tqdm import tqdm
@@ -37,8 +41,18 @@ from clkhash.validate_data import (
     validate_row_lengths,
 )
 
+if TYPE_CHECKING:
+    from multiprocessing.synchronize import Event
+
 log = logging.getLogger("clkhash.clk")
 
+# Bounds on the number of records hashed together by a worker process.
+MIN_CHUNK_SIZE = 1_000
+MAX_CHUNK_SIZE = 10_000
+CHUNKS_PER_WORKER = 4
+# Seconds between checks for a request to stop while waiting on a queue.
+STOP_POLL_INTERVAL = 0.1
+
 
 def hash_chunk(
     chunk_pii_data: Sequence[Sequence[str]],
@@ -66,29 +80,85 @@ def hash_chunk(
         validate_entries(schema.fields, chunk_pii_data, row_index_offset)
     clk_data = []
     clk_popcounts = []
-    for clk in stream_bloom_filters(chunk_pii_data, keys, schema):
-        clk_data.append(clk[0])
-        clk_popcounts.append(clk[2])
+    for clk, _, popcount in stream_bloom_filters(chunk_pii_data, keys, schema):
+        clk_data.append(clk)
+        clk_popcounts.append(popcount)
     return clk_data, clk_popcounts
 
 
-def iterable_to_queue(iterable: Iterable[Sequence], queue: Queue, number_of_sentinels:int = 1, sentinel=None):
+def iterable_to_queue(iterable: Iterable[Sequence], queue: Queue, number_of_sentinels:int = 1, sentinel=None,
+                      stop: Optional[Event] = None):
     """
     Consumes an iterable placing all items into a queue, appending sentinel values at the end.
+
+    If the stop event is set, it returns without placing further items or the sentinels.
     """
     for item in iterable:
-        queue.put(item)
+        if not put_unless_stopped(queue, item, stop):
+            return
 
     for _ in range(number_of_sentinels):
-        queue.put(sentinel)
+        if not put_unless_stopped(queue, sentinel, stop):
+            return
+
+
+def put_unless_stopped(queue: Queue, item, stop: Optional[Event] = None) -> bool:
+    """
+    Puts an item into a bounded queue, waiting while it is full unless the stop event is set.
+
+    :return: Whether the item was put into the queue.
+    """
+    if stop is None:
+        queue.put(item)
+        return True
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=STOP_POLL_INTERVAL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def get_unless_stopped(queue: Queue, stop: Optional[Event] = None):
+    """
+    Gets an item from a queue, waiting while it is empty unless the stop event is set.
+
+    :return: The item, or None if the queue is empty and the stop event is set.
+    """
+    if stop is None:
+        return queue.get()
+    while True:
+        try:
+            return queue.get(timeout=STOP_POLL_INTERVAL)
+        except Empty:
+            if stop.is_set():
+                return None
+
+
+def throttled(iterable: Iterable[T], semaphore: BoundedSemaphore, stop: Optional[Event] = None) -> Iterator[T]:
+    """
+    Yields the items of an iterable, acquiring the semaphore before each one.
+
+    The consumer releases the semaphore once it is done with an item, which bounds
+    the number of items in flight. If the stop event is set, it stops once the
+    semaphore is acquired, so the consumer should release it after setting the event.
+    """
+    for item in iterable:
+        semaphore.acquire()
+        if stop is not None and stop.is_set():
+            return
+        yield item
 
 
 def process_chuck_with_queues(
     chunk_queue: Queue[Optional[Tuple[int, Sequence[Sequence[str]]]]],
-    results_queue: Queue[Optional[Tuple[list[bitarray], list[int], int]]],
+    results_queue: Queue[Union[None, BaseException, Tuple[list[bitarray], list[int], int]]],
     keys: Sequence[Sequence[bytes]],
     schema: Schema,
     validate_data: bool,
+    chunk_size: int = MAX_CHUNK_SIZE,
+    stop: Optional[Event] = None,
 ):
     """
     Encodes chunks of Personally Identifiable Information (PII) from a source queue,
@@ -101,17 +171,27 @@ def process_chuck_with_queues(
             been created by the `generate_key_lists` function.
     :param schema: The schema defining the entry formats and hashing settings.
     :param validate_data: Whether to validate the PII data against the format specification.
+    :param chunk_size: The number of records in every chunk but the last, used to report
+            the row index of validation errors.
+    :param stop: Once this event is set, the remaining chunks are taken off the
+            `chunk_queue` without being encoded.
 
     The function will stop processing once it encounters a `None` in the `chunk_queue`,
-    which is added to the result queue.
+    or once the `stop` event is set and the `chunk_queue` is empty. It then puts a `None`
+    on the result queue. If encoding a chunk fails, e.g. because of an invalid entry, the
+    exception is put on the result queue instead.
     """
-    while chunk_info := chunk_queue.get():
-        if chunk_info is None:
-            break
-        chunk_index, chunk = chunk_info
-        offset = chunk_index * len(chunk)
-        clk_data, clk_popcounts = hash_chunk(chunk, keys, schema, validate_data, offset)
-        results_queue.put((clk_data, clk_popcounts, chunk_index))
+    try:
+        while (chunk_info := get_unless_stopped(chunk_queue, stop)) is not None:
+            if stop is not None and stop.is_set():
+                continue
+            chunk_index, chunk = chunk_info
+            offset = chunk_index * chunk_size
+            clk_data, clk_popcounts = hash_chunk(chunk, keys, schema, validate_data, offset)
+            results_queue.put((clk_data, clk_popcounts, chunk_index))
+    except Exception as e:
+        results_queue.put(e)
+        return
 
     results_queue.put(None)
 
@@ -150,11 +230,44 @@ def generate_clk_from_csv(
         that are not capable of spawning subprocesses.
     :return: A list of Bloom filters as bitarrays.
     """
+    return list(
+        iter_clk_from_csv(
+            input_f,
+            secret,
+            schema,
+            validate=validate,
+            header=header,
+            progress_bar=progress_bar,
+            max_workers=max_workers,
+        )
+    )
+
+
+def iter_clk_from_csv(
+    input_f: TextIO,
+    secret: AnyStr,
+    schema: Schema,
+    validate: bool = True,
+    header: Union[bool, AnyStr] = True,
+    progress_bar: bool = True,
+    max_workers: Optional[int] = None,
+) -> Iterator[bitarray]:
+    """Generate Bloom filters for the records of a CSV file, one at a time.
+
+    Takes the same arguments as :func:`generate_clk_from_csv`, but
+    yields the Bloom filters as the chunks they belong to are hashed,
+    so that the whole list of them never has to be held in memory.
+    The arguments and the header are checked when it is called, before
+    any record is hashed.
+
+    :return: An iterator over the Bloom filters as bitarrays.
+    """
     if header not in {False, True, "ignore"}:
         raise ValueError(
             "header must be False, True or 'ignore' but is {!s}.".format(header)
         )
 
+    advise_sequential(input_f)
     record_count = line_count(input_f)
 
     reader = csv.reader(input_f)
@@ -163,7 +276,17 @@ def generate_clk_from_csv(
         if header != "ignore":
             validate_header(schema.fields, column_names)
 
-    if progress_bar:
+    if not progress_bar:
+        return iter_clks_from_csv_as_stream(
+            reader,
+            record_count,
+            schema,
+            secret,
+            validate=validate,
+            max_workers=max_workers,
+        )
+
+    def with_progress_bar() -> Iterator[bitarray]:
         stats = OnlineMeanVariance()
         with tqdm(
             desc="generating CLKs",
@@ -178,7 +301,7 @@ def generate_clk_from_csv(
                 pbar.set_postfix(mean=stats.mean(), std=stats.std(), refresh=False)
                 pbar.update(tics)
 
-            results = generate_clks_from_csv_as_stream(
+            yield from iter_clks_from_csv_as_stream(
                 reader,
                 record_count,
                 schema,
@@ -187,16 +310,8 @@ def generate_clk_from_csv(
                 callback=callback,
                 max_workers=max_workers,
             )
-    else:
-        results = generate_clks_from_csv_as_stream(
-            reader,
-            record_count,
-            schema,
-            secret,
-            validate=validate,
-            max_workers=max_workers,
-        )
-    return results
+
+    return with_progress_bar()
 
 
 def generate_clks(
@@ -227,6 +342,31 @@ def generate_clks_from_csv_as_stream(
     callback: Optional[Callable[[int, Sequence[int]], None]] = None,
     max_workers: Optional[int] = None,
 ) -> List[bitarray]:
+    return list(
+        iter_clks_from_csv_as_stream(
+            data,
+            record_count,
+            schema,
+            secret,
+            validate=validate,
+            callback=callback,
+            max_workers=max_workers,
+        )
+    )
+
+
+def iter_clks_from_csv_as_stream(
+    data: Iterable[Sequence[str]],
+    record_count: int,
+    schema: Schema,
+    secret: AnyStr,
+    validate: bool = True,
+    callback: Optional[Callable[[int, Sequence[int]], None]] = None,
+    max_workers: Optional[int] = None,
+) -> Iterator[bitarray]:
+    """Generate Bloom filters for the records of data, yielding them in
+    order as each chunk of records is hashed.
+    """
     # Generate two keys for each identifier from the secret, one key per hashing method used when computing
     # the bloom filters.
     # Otherwise, it could create more if required using the parameter `num_hashing_methods` in `generate_key_lists`
@@ -241,24 +381,44 @@ def generate_clks_from_csv_as_stream(
     )
 
     # Chunk PII
-    chunk_size = 10_000
-    if record_count < chunk_size:
+    chunk_size = MAX_CHUNK_SIZE
+    if record_count < MAX_CHUNK_SIZE:
         max_workers = 1
 
-    results: List = []
     if max_workers is None or max_workers > 1:
         max_workers = (
             multiprocessing.cpu_count() if max_workers is None else max_workers
         )
+        # Aim for a few chunks per worker, so that the work is spread evenly
+        # and no worker is left with a long tail at the end.
+        chunk_size = max(
+            MIN_CHUNK_SIZE,
+            min(MAX_CHUNK_SIZE, record_count // (CHUNKS_PER_WORKER * max_workers)),
+        )
         # We put chunks of raw data into the queue
         queue: Queue[Tuple[int, Sequence[Sequence[str]]]] = Queue(maxsize=1 * max_workers)
-        results_queue: Queue[Optional[Tuple[int, List[bitarray], int]]] = Queue()
+        results_queue: Queue[Union[None, BaseException, Tuple[List[bitarray], List[int], int]]] = Queue()
+
+        # The results of chunks finished out of order are held until the earlier chunks
+        # are done, and those in order until the caller consumes them. Bounding the chunks
+        # in flight bounds the memory they use.
+        in_flight = BoundedSemaphore(2 * max_workers)
+        # Set if the caller stops iterating early or an error is raised, to stop the
+        # producer and the workers.
+        stop = multiprocessing.Event()
+
+        def produce():
+            try:
+                iterable_to_queue(throttled(chunks(data, chunk_size), in_flight, stop),
+                                  queue, max_workers, stop=stop)
+            except Exception as e:
+                # e.g. the CSV cannot be decoded. Hand the error to the consumer, which
+                # raises it and then stops the workers. Setting stop here instead could
+                # let the workers finish before the error reaches the consumer.
+                results_queue.put(e)
 
         # producer thread that consumes the iterable and puts chunk_size batches into a fixed size queue
-        producer_thread = Thread(
-            target=iterable_to_queue,
-            args=(chunks(data, chunk_size), queue, max_workers),
-        )
+        producer_thread = Thread(target=produce, daemon=True)
         producer_thread.start()
 
         consumers = []
@@ -270,22 +430,48 @@ def generate_clks_from_csv_as_stream(
                     "keys": key_lists,
                     "schema": schema,
                     "validate_data": validate,
+                    "chunk_size": chunk_size,
+                    "stop": stop,
                 },
             )
             p.start()
             consumers.append(p)
 
-        for result in queue_to_sorted_iterable(results_queue, max_workers):
-            (clks, clk_stats, chunk_idx) = result
-
-            if callback is not None:
-                callback(len(clks), clk_stats)
-
-            results.extend(clks)
+        finished = False
+        try:
+            for result in queue_to_sorted_iterable(results_queue, max_workers):
+                (clks, clk_stats, chunk_idx) = result
+
+                if callback is not None:
+                    callback(len(clks), clk_stats)
+
+                yield from clks
+                in_flight.release()
+            finished = True
+        finally:
+            if not finished:
+                # The caller stopped iterating early or an error is raised. Wake the
+                # producer if it waits for a chunk to be consumed, and let the workers
+                # take the chunks left in the queue without encoding them, so that no
+                # thread stays blocked on a full queue or pipe. The results still to
+                # come are dropped.
+                stop.set()
+                try:
+                    in_flight.release()
+                except ValueError:
+                    pass  # The producer is not waiting.
+                while any(p.is_alive() for p in consumers):
+                    try:
+                        results_queue.get(timeout=STOP_POLL_INTERVAL)
+                    except Empty:
+                        pass
+                queue.cancel_join_thread()
+            for p in consumers:
+                p.join()
+            producer_thread.join()
+            queue.close()
 
     else:
-        results = []
-
         for chunk_idx, chunk in chunks(data, chunk_size):
             clks, clk_stats = hash_chunk(
                 chunk, key_lists, schema, validate, chunk_idx * chunk_size
@@ -293,8 +479,7 @@ def generate_clks_from_csv_as_stream(
             if callback is not None:
                 unpacked_callback = cast(Callable[[int, Sequence[int]], None], callback)
                 unpacked_callback(len(clks), clk_stats)
-            results.extend(clks)
-    return results
+            yield from clks
 
 
 T = TypeVar("T")  # Declare generic type variable
@@ -326,16 +511,75 @@ def chunks(
         idx += 1
 
 
+def advise_sequential(file: TextIO) -> None:
+    """Tell the OS that the file will be read sequentially.
+
+    This allows more aggressive read-ahead. It is only a hint, so it is
+    silently skipped for streams without a file descriptor and on
+    platforms without ``posix_fadvise``.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
 def line_count(file: TextIO) -> int:
     """counts the number of lines in a textfile"""
+    count = _binary_line_count(file)
+    if count is None:
+        count = sum(bl.count("\n") for bl in _blocks(file))
+    file.seek(0)
+    return count
+
+
+def _blocks(file: IO[AnyStr], size: int = 65536) -> Iterator[AnyStr]:
+    while True:
+        b = file.read(size)
+        if not b:
+            break
+        yield b
 
-    def blocks(file: TextIO, size=65536):
-        while True:
-            b = file.read(size)
-            if not b:
-                break
-            yield b
 
-    count = sum(bl.count("\n") for bl in blocks(file))
+def _binary_line_count(file: TextIO) -> Optional[int]:
+    """Counts the newlines of a text file in its underlying binary buffer.
+
+    This skips decoding the file, which is the bulk of the work for non-ASCII text.
+    It only applies to files read from the start, in an encoding that writes line
+    breaks as ASCII bytes. Text mode may translate lone carriage returns into
+    newlines, so if any are found the count is abandoned. None is returned whenever
+    the fast path does not apply.
+    """
+    buffer = getattr(file, "buffer", None)
+    encoding = getattr(file, "encoding", None)
+    try:
+        if buffer is None or encoding is None or file.tell() != 0:
+            return None
+        if "\r\n".encode(encoding) != b"\r\n":
+            return None
+    except (LookupError, OSError, ValueError):
+        return None
+
+    # Make sure the buffer is at the start and not ahead of the text file.
+    file.seek(0)
+    count = 0
+    ends_with_cr = False
+    lone_cr = False
+    for block in _blocks(buffer):
+        if ends_with_cr and not block.startswith(b"\n"):
+            lone_cr = True
+            break
+        ends_with_cr = block.endswith(b"\r")
+        if b"\r" in block and (
+            block.count(b"\r") - block.count(b"\r\n") - ends_with_cr
+        ):
+            lone_cr = True
+            break
+        count += block.count(b"\n")
+    # Rewind the text file, which also resets its view of the buffer.
     file.seek(0)
+    if lone_cr or ends_with_cr:
+        return None
     return count
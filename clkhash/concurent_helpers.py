@@ -2,13 +2,14 @@ from __future__ import annotations
 
 import heapq
 from multiprocessing import Queue
-from typing import Iterator, Tuple, List, TypeVar, Optional
+from typing import Iterator, Tuple, List, TypeVar, Optional, Union
 
 A = TypeVar('A')
 B = TypeVar('B')
 ENCODED_CHUNK = Tuple[A, B, int]
 
-def queue_to_sorted_iterable(queue: Queue[Optional[ENCODED_CHUNK]], sentinel_count: int) -> Iterator[ENCODED_CHUNK]:
+def queue_to_sorted_iterable(queue: Queue[Union[None, BaseException, ENCODED_CHUNK]],
+                             sentinel_count: int) -> Iterator[ENCODED_CHUNK]:
     """
     Consume items from a multiprocessing Queue and yield them in order of their index.
 
@@ -16,6 +17,7 @@ def queue_to_sorted_iterable(queue: Queue[Optional[ENCODED_CHUNK]], sentinel_cou
     that a producer has finished) or a tuple `(_, _, index)`. The function will continue consuming
     items from the queue until it has received `sentinel_count` sentinel values, at which point it
     will assume that all producers have finished and no more items will be added to the queue.
+    A producer that fails puts its exception on the queue instead, which is raised here.
 
     The function maintains a heap (priority queue) to keep track of out-of-order items. As items
     are consumed from the queue, they are added to the heap until the function finds the next item
@@ -36,6 +38,8 @@ def queue_to_sorted_iterable(queue: Queue[Optional[ENCODED_CHUNK]], sentinel_cou
                 seen_sentinels += 1
                 if seen_sentinels == sentinel_count:
                     break
+            elif isinstance(item, BaseException):
+                raise item
             else:
                 # heapq uses the first element of the tuple for sorting
                 # So, we add index as the first element
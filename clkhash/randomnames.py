@@ -36,8 +36,8 @@ def save_csv(data: Iterable[Tuple[Union[str, int], ...]],
     :param file: A writeable stream in which to write the CSV
     """
 
-    print(','.join(headers), file=file)
     writer = csv.writer(file)
+    writer.writerow(headers)
     writer.writerows(data)
 
 
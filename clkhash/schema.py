@@ -5,8 +5,7 @@ import json
 import pkgutil
 from typing import Any, Dict, Hashable, Optional, Sequence, Text, TextIO
 from copy import deepcopy
-
-import jsonschema
+from functools import lru_cache
 
 from clkhash.field_formats import FieldSpec, spec_from_json_dict, InvalidSchemaError
 from clkhash.key_derivation import DEFAULT_KEY_SIZE as DEFAULT_KDF_KEY_SIZE
@@ -202,9 +201,11 @@ def from_json_dict(dct: Dict[str, Any], validate: bool = True) -> Schema:
     if validate:
         # This raises iff the schema is invalid.
         validate_schema_dict(dct)
-    dct = convert_to_latest_version(dct)
-    if validate:
-        validate_schema_dict(dct)
+    latest_dct = convert_to_latest_version(dct)
+    if validate and latest_dct is not dct:
+        # A schema already at the latest version was validated above.
+        validate_schema_dict(latest_dct)
+    dct = latest_dct
     clk_config = dct['clkConfig']
     l = clk_config['l']
     xor_folds = clk_config.get('xor_folds', 0)
@@ -254,9 +255,7 @@ def from_json_file(schema_file: TextIO, validate: bool = True) -> Schema:
     """
     try:
         schema_dict = json.load(schema_file)
-    except ValueError as e:  # In Python 3 we can be more specific
-        # with json.decoder.JSONDecodeError,
-        # but that doesn't exist in Python 2.
+    except ValueError as e:
         msg = 'The schema is not a valid JSON file.'
         raise SchemaError(msg) from e
 
@@ -281,6 +280,16 @@ def _get_master_schema(version: Hashable) -> dict:
                'Consider updating clkhash.').format(version)
         raise SchemaError(msg) from e
 
+    return _load_master_schema(file_name)
+
+
+@lru_cache(maxsize=None)
+def _load_master_schema(file_name: str) -> dict:
+    """ Loads and parses a master schema file shipped with clkhash.
+
+        The result is cached, so the packaged JSON is only read and
+        parsed once per process. It must not be modified.
+    """
     try:
         schema_bytes = pkgutil.get_data('clkhash', f'schemas/{file_name}')
         if schema_bytes is None:
@@ -301,6 +310,21 @@ def _get_master_schema(version: Hashable) -> dict:
         raise MasterSchemaError(msg) from e
 
 
+@lru_cache(maxsize=None)
+def _master_schema_validator(file_name: str) -> Any:
+    """ Creates a jsonschema validator for a master schema file.
+
+        Checking the master schema against its meta-schema and building
+        the validator is done once per file rather than on every
+        validation.
+    """
+    import jsonschema
+    master_schema = _load_master_schema(file_name)
+    validator_class = jsonschema.validators.validator_for(master_schema)
+    validator_class.check_schema(master_schema)
+    return validator_class(master_schema)
+
+
 def validate_schema_dict(schema: Dict[str, Any]) -> None:
     """ Validate the schema.
 
@@ -321,10 +345,17 @@ def validate_schema_dict(schema: Dict[str, Any]) -> None:
     else:
         raise SchemaError('A format version is expected in the schema.')
 
-    master_schema = _get_master_schema(version)
+    # This raises if the version is unknown or the master schema is missing.
+    _get_master_schema(version)
 
+    # Imported here, as jsonschema is slow to import and only needed for
+    # validation.
+    import jsonschema
     try:
-        jsonschema.validate(schema, master_schema)
+        validator = _master_schema_validator(MASTER_SCHEMA_FILE_NAMES[version])
+        error = jsonschema.exceptions.best_match(validator.iter_errors(schema))
+        if error is not None:
+            raise error
     except jsonschema.exceptions.ValidationError as e:
         raise SchemaError('The schema is not valid.\n\n' + str(e)) from e
     except jsonschema.exceptions.SchemaError as e:
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
 """
-Serialize bitarray to/from base64 utf-8 encoded string
+Serialize bitarray to/from base64 encoded string
 """
 
 import base64
+from typing import List, Sequence
+
 from bitarray import bitarray
 
 
@@ -12,7 +14,37 @@ def serialize_bitarray(ba: bitarray) -> str:
     """Serialize a bitarray (Bloom filter)
     Creates a base64 encoded string representation of the provided bitarray.
     """
-    return base64.b64encode(ba.tobytes()).decode('utf8')
+    return base64.b64encode(ba.tobytes()).decode('ascii')
+
+
+def serialize_bitarrays(bas: Sequence[bitarray]) -> List[str]:
+    """Serialize a sequence of bitarrays (Bloom filters)
+
+    Produces the same strings as calling :func:`serialize_bitarray` on
+    each bitarray, but base64 encodes all of them in a single call if
+    they are all of the same length.
+    """
+    if not bas:
+        return []
+    num_bits = len(bas[0])
+    if num_bits == 0 or any(len(ba) != num_bits for ba in bas):
+        return [serialize_bitarray(ba) for ba in bas]
+
+    # base64 encodes groups of 3 bytes. We pad every bitarray to a whole
+    # number of groups, so that no group spans two bitarrays, and
+    # restore the '=' padding of the individual encodings afterwards.
+    num_bytes = (num_bits + 7) // 8
+    padding = -num_bytes % 3
+    pad = bytes(padding)
+    encoded = base64.b64encode(
+        pad.join(ba.tobytes() for ba in bas) + pad).decode('ascii')
+
+    encoded_len = (num_bytes + padding) // 3 * 4
+    sers = [encoded[i:i + encoded_len]
+            for i in range(0, len(encoded), encoded_len)]
+    if padding:
+        sers = [ser[:-padding] + '=' * padding for ser in sers]
+    return sers
 
 
 def deserialize_bitarray(ser: str) -> bitarray:
@@ -1,5 +1,4 @@
 import os
-import sys
 import tempfile
 import clkhash
 
@@ -56,7 +55,4 @@ def create_temp_file(suffix=''):
     Note this file will not be automatically deleted by Python.
     """
     os_fd, filename = tempfile.mkstemp(suffix=suffix, text=True)
-    if sys.version_info[0] >= 3:
-        return open(filename, 'wt', encoding='utf8', newline='')
-    else:
-        return open(filename, 'wt')
+    return open(filename, 'wt', encoding='utf8', newline='')
@@ -4,19 +4,17 @@ import pytest
 import unittest
 import pytest
 import os
-import sys
 
 from clkhash import benchmark
 
 IS_APPVEYOR = 'APPVEYOR' in os.environ
 IS_TRAVIS = 'TRAVIS' in os.environ
-IS_PY3 = sys.version_info[0] >= 3
 ON_CI = IS_APPVEYOR or IS_TRAVIS
 
 
 class TestBenchmark(unittest.TestCase):
 
-    @pytest.mark.skipif(IS_APPVEYOR and IS_PY3, reason="Windows benchmarking not working on Python3")
+    @pytest.mark.skipif(IS_APPVEYOR, reason="Windows benchmarking not working on Python3")
     def test_benchmarking_hash(self):
         # blind run to give the JIT compiler of PyPy a chance to optimize
         benchmark.compute_hash_speed(1000, quiet=True)
@@ -1,8 +1,15 @@
+import hmac
 import random
+import struct
 import unittest
 from copy import copy
+from hashlib import blake2b
 
-from clkhash.bloomfilter import (blake_encode_ngrams,
+from clkhash.bloomfilter import (_digest_mod,
+                                 _hmac_contexts,
+                                 _hmac_digest,
+                                 blake_encode_ngrams,
+                                 blake_hash_token,
                                  double_hash_encode_ngrams,
                                  double_hash_encode_ngrams_non_singular,
                                  hashing_function_from_properties)
@@ -65,6 +72,30 @@ class TestEncoding(unittest.TestCase):
                 self.key_sha1, self.key_md5), self.ks, 1024, 'ascii'),
             copy(self.ngrams))
 
+    def test_blake_hash_token(self):
+        token = b'ab'
+        k = 40  # needs two MACs
+        shorts = []
+        for i in range(2):
+            digest = blake2b(token, key=self.key_sha1, salt=str(i).encode()).digest()
+            shorts.extend(struct.unpack('32H', digest))
+        expected = [s % 1024 for s in shorts[:k]]
+        self.assertEqual(list(blake_hash_token(token, k, self.key_sha1, 1024)), expected)
+
+    def test_hmac_contexts(self):
+        long_key = bytes(bytearray(random.getrandbits(8) for _ in range(100)))
+        for key in (self.key_sha1, long_key):
+            for digestmod in ('sha1', 'md5'):
+                for token in (b'', b'ab', b'x' * 200):
+                    self.assertEqual(
+                        _hmac_digest(_hmac_contexts(key, digestmod), token),
+                        hmac.new(key, token, digestmod).digest())
+
+    def test_digest_mod(self):
+        for digest in (bytes(20), b'\xff' * 16, bytes(bytearray(random.getrandbits(8) for _ in range(20)))):
+            for l in (1, 997, 1000, 1024, 2 ** 20, 2 ** 64, 2 ** 70):
+                self.assertEqual(_digest_mod(digest, l), int.from_bytes(digest, 'big') % l)
+
     def _test_order_of_ngrams(self, enc_function, ngrams):
         bf1 = enc_function(ngrams)
         random.shuffle(ngrams)
@@ -1,11 +1,14 @@
 # -*- encoding: utf-8 -*-
 import io
 import os
+import queue
 import tempfile
 import textwrap
+import threading
 import unittest
 
 from clkhash import clk, schema, randomnames, validate_data
+from clkhash.key_derivation import generate_key_lists
 from clkhash.serialization import serialize_bitarray
 
 
@@ -31,6 +34,89 @@ class TestChunks(unittest.TestCase):
         self.assertEqual((10, 11, 12, 13, 14, 15, 16), res[1])
 
 
+class TestProcessChunk(unittest.TestCase):
+
+    def test_row_index_in_short_last_chunk(self):
+        s = randomnames.NameList.SCHEMA
+        keys = generate_key_lists('secret', len(s.fields))
+        chunk_size, chunk_index = 3, 2
+        last_chunk = [('6', 'Jane Austen', '1775/12/16', 'F'),
+                      ('7', 'Bob Hawke', '1929/12/09', 'invalid')]
+        chunk_queue = queue.Queue()
+        chunk_queue.put((chunk_index, last_chunk))
+        chunk_queue.put(None)
+        results_queue = queue.Queue()
+
+        clk.process_chuck_with_queues(chunk_queue, results_queue, keys, s,
+                                      validate_data=True, chunk_size=chunk_size)
+        error = results_queue.get_nowait()
+        self.assertIsInstance(error, validate_data.EntryError)
+        self.assertEqual(error.row_index, chunk_index * chunk_size + 1)
+        self.assertTrue(results_queue.empty())
+
+    def test_invalid_entry_raised_with_several_workers(self):
+        s = randomnames.NameList.SCHEMA
+        pii = [('0', 'Jane Doe', '1980/01/01', 'F')] * (2 * clk.MAX_CHUNK_SIZE + 500)
+        invalid_row = len(pii) - 2
+        pii[invalid_row] = ('1', 'John Doe', '1980/01/01', 'invalid')
+
+        with self.assertRaises(validate_data.EntryError) as cm:
+            clk.generate_clks(pii, s, 'secret', max_workers=2)
+        self.assertEqual(cm.exception.row_index, invalid_row)
+
+
+class TestIterClksFromCsvAsStream(unittest.TestCase):
+
+    def test_close_early_stops_threads(self):
+        s = randomnames.NameList.SCHEMA
+        pii = [('0', 'Jane Doe', '1980/01/01', 'F')] * (2 * clk.MAX_CHUNK_SIZE)
+        threads_before = set(threading.enumerate())
+
+        it = clk.iter_clks_from_csv_as_stream(iter(pii), len(pii), s, 'secret', max_workers=2)
+        self.assertEqual(len(next(it)), s.l)
+        it.close()
+
+        self.assertEqual(set(threading.enumerate()) - threads_before, set())
+
+    def test_undecodable_input_raises(self):
+        s = randomnames.NameList.SCHEMA
+        rows = b'0,Jane Doe,1980/01/01,F\n' * (2 * clk.MAX_CHUNK_SIZE) + b'1,J\xffne Doe,1980/01/01,F\n'
+        os_fd, tmpfile_name = tempfile.mkstemp()
+        with open(tmpfile_name, 'wb') as f:
+            f.write(rows)
+        try:
+            with open(tmpfile_name, encoding='utf-8') as f:
+                with self.assertRaises(UnicodeDecodeError):
+                    clk.generate_clk_from_csv(f, 'secret', s, header=False,
+                                              progress_bar=False, max_workers=2)
+        finally:
+            os.close(os_fd)
+            os.remove(tmpfile_name)
+
+
+class TestLineCount(unittest.TestCase):
+
+    def test_line_count(self):
+        contents = [b'', b'a\nb\n', b'a\nb', b'a\r\nb\r\n', b'a\rb\n', b'a\r',
+                    'K\u00c9VIN\nJ\u00dcRGEN\n'.encode('utf-8'),
+                    b'x' * 65535 + b'\r\nx\n', b'x' * 65535 + b'\rx\n']
+        for content in contents:
+            os_fd, tmpfile_name = tempfile.mkstemp()
+            with open(tmpfile_name, 'wb') as f:
+                f.write(content)
+            for newline in (None, ''):
+                with open(tmpfile_name, encoding='utf-8', newline=newline) as f:
+                    expected = f.read().count('\n')
+                    f.seek(0)
+                    self.assertEqual(clk.line_count(f), expected)
+                    self.assertEqual(f.tell(), 0)
+            os.close(os_fd)
+            os.remove(tmpfile_name)
+
+    def test_line_count_text_stream(self):
+        self.assertEqual(clk.line_count(io.StringIO('a\nb\nc')), 2)
+
+
 class TestComplexSchemaChanges(unittest.TestCase):
     def setUp(self):
         CSV_INPUT = textwrap.dedent("""\
@@ -162,6 +248,20 @@ class TestComplexSchemaChanges(unittest.TestCase):
 
         assert len(results) == 3
 
+    def test_iter_clk_from_csv(self):
+        loaded_schema = schema.from_json_dict(self.SCHEMA_DICT)
+
+        results = clk.iter_clk_from_csv(
+            self.CSV_FILE,
+            self.SECRET,
+            loaded_schema,
+            progress_bar=False)
+
+        self.assertNotIsInstance(results, list)
+        expected = clk.generate_clks(
+            self.PI_INPUT_NO_HEADER, loaded_schema, self.SECRET)
+        self.assertEqual(list(results), expected)
+
     def test_encoding_regression(self):
         loaded_schema = schema.from_json_dict(self.SCHEMA_DICT)
 
@@ -244,6 +344,17 @@ class TestHeaderChecking(unittest.TestCase):
                 header=True,
                 progress_bar=False)
 
+    def test_iter_checks_header_when_called(self):
+        with open(self.csv_correct_header, 'rt') as f:
+            with self.assertRaises(ValueError):
+                clk.iter_clk_from_csv(f, 'open sesame', self.schema,
+                                      header='bogus', progress_bar=False)
+
+        with open(self.csv_incorrect_header_name, 'rt') as f:
+            with self.assertRaises(validate_data.FormatError):
+                clk.iter_clk_from_csv(f, 'open sesame', self.schema,
+                                      header=True, progress_bar=False)
+
     def test_ignore_header(self):
         out = clk.generate_clk_from_csv(
             open(self.csv_correct_header,'rt'),
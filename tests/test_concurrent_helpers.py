@@ -56,6 +56,17 @@ class TestQueueToSortedIterable(unittest.TestCase):
         result = list(queue_to_sorted_iterable(queue, sentinel_count))
         self.assertEqual(result, [])
 
+    def test_queue_to_sorted_iterable_raises_error(self):
+        """
+        Test that an exception put on the queue by a producer is raised.
+        """
+        queue = Queue()
+        queue.put(('a', 'b', 1))
+        queue.put(ValueError('producer failed'))
+        queue.put(None)
+        with self.assertRaisesRegex(ValueError, 'producer failed'):
+            list(queue_to_sorted_iterable(queue, 1))
+
     @given(st.lists(st.tuples(st.integers(), st.integers(), st.integers(min_value=0)),
            min_size=1, unique_by=lambda x: x[2]))
     def test_queue_to_sorted_iterable_multiple_items(self, items):
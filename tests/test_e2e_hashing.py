@@ -10,7 +10,7 @@ from clkhash.field_formats import FieldHashingProperties, StringSpec, BitsPerTok
 from clkhash.key_derivation import generate_key_lists
 from clkhash.schema import Schema
 from clkhash.stats import OnlineMeanVariance
-from clkhash.comparators import get_comparator
+from clkhash.comparators import get_comparator, NonComparison
 
 TEST_DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'testdata')
 
@@ -239,3 +239,20 @@ class TestHashingWithDifferentHashFunctions(unittest.TestCase):
         bf_reversed = next(bloomfilter.stream_bloom_filters(pii, keys, schema))
 
         self.assertNotEqual(bf[0], bf_reversed[0])
+
+
+class TestRepeatedValues(unittest.TestCase):
+
+    def test_stream_matches_single_records(self):
+        s = randomnames.NameList.SCHEMA
+        keys = generate_key_lists('secret', len(s.fields))
+        pii = [('0', 'Jane Doe', '1980/01/01', 'F'),
+               ('1', 'John Doe', '1980/01/01', 'M'),
+               ('2', 'Jane Doe', '1991/12/31', 'F')] * 2
+        comparators = [f.hashing_properties.comparator if f.hashing_properties else NonComparison()
+                       for f in s.fields]
+        streamed = [bf for bf, _, _ in bloomfilter.stream_bloom_filters(pii, keys, s)]
+        single = [bloomfilter.crypto_bloom_filter(record, comparators, s, keys)[0]
+                  for record in pii]
+        self.assertEqual(streamed, single)
+        self.assertEqual(streamed[:3], streamed[3:])
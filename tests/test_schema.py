@@ -86,6 +86,10 @@ class TestSchemaValidation(unittest.TestCase):
 
         schema.MASTER_SCHEMA_FILE_NAMES = original_paths
 
+    def test_master_schema_loaded_once(self):
+        self.assertIs(schema._get_master_schema(3),
+                      schema._get_master_schema(3))
+
     def test_schema_conversion(self):
         schema_v1 = _schema_dict(DATA_DIRECTORY, GOOD_SCHEMA_V1_PATH)
         assert schema_v1['version'] == 1
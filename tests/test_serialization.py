@@ -4,7 +4,8 @@ import unittest
 from bitarray import bitarray
 from math import ceil
 
-from clkhash.serialization import serialize_bitarray, deserialize_bitarray
+from clkhash.serialization import (serialize_bitarray, serialize_bitarrays,
+                                   deserialize_bitarray)
 
 
 def generate_random_bitarray(num_bytes):
@@ -24,3 +25,22 @@ class TestSerialization(unittest.TestCase):
 
         des = deserialize_bitarray(ser)
         self.assertEqual(ba, des)
+
+    def test_serialize_bitarrays(self):
+        for num_bits in (8, 16, 24, 1000, 1024, 2048):
+            bas = [generate_random_bitarray(num_bits // 8) for _ in range(5)]
+            self.assertEqual(serialize_bitarrays(bas),
+                             [serialize_bitarray(ba) for ba in bas])
+
+    def test_serialize_bitarrays_partial_byte(self):
+        bas = [bitarray('10110'), bitarray('01101')]
+        self.assertEqual(serialize_bitarrays(bas),
+                         [serialize_bitarray(ba) for ba in bas])
+
+    def test_serialize_bitarrays_mixed_lengths(self):
+        bas = [generate_random_bitarray(num_bytes) for num_bytes in (3, 4, 128)]
+        self.assertEqual(serialize_bitarrays(bas),
+                         [serialize_bitarray(ba) for ba in bas])
+
+    def test_serialize_bitarrays_empty(self):
+        self.assertEqual(serialize_bitarrays([]), [])
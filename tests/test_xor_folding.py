@@ -9,35 +9,6 @@ from clkhash.key_derivation import generate_key_lists
 from clkhash.schema import Schema
 
 
-try:
-    to_bytes = int.to_bytes
-except AttributeError:
-    # We are in Python 2.
-    def to_bytes(n,            # int
-                 length,       # int
-                 endianess,    # str
-                 signed=False  # DefaultNamedArg(bool, 'signed')
-                 ):
-        # type (...) -> bytes
-        if signed:
-            raise ValueError(
-                "This dirty backport of int.to_bytes doesn't support signed "
-                'integers. Implement it yourself, or better yet, switch to '
-                'Python 3.')
-            # Kudos: https://stackoverflow.com/a/20793663
-        # With modifications for style.
-        hex_str = '{:X}'.format(n)
-        if len(hex_str) > length * 2:
-            raise OverflowError('int too big to convert')
-        b = hex_str.zfill(length * 2).decode('hex')
-        if endianess == 'big':
-            return b
-        elif endianess == 'little':
-            return b[::-1]
-        else:
-            raise ValueError("byteorder must be either 'little' or 'big'")
-
-
 def random_bitarray(length,    # type: int
                     seed=None  # type: int
                     ):
@@ -46,7 +17,7 @@ def random_bitarray(length,    # type: int
     random_bits = random.getrandbits(length)
 
     ba = bitarray()
-    ba.frombytes(to_bytes(random_bits, (length + 7) // 8, 'big'))
+    ba.frombytes(random_bits.to_bytes((length + 7) // 8, 'big'))
     return ba[-length:]
 
 